@@ -1,3 +1,10 @@
+import os
+
+# pin every process to one OpenMP/MKL thread before torch is imported.
+# cpu_count workers each spawning cpu_count threads oversubscribes the cpu on these tiny matmuls
+os.environ["OMP_NUM_THREADS"] = "1"
+os.environ["MKL_NUM_THREADS"] = "1"
+
 import gym
 import numpy as np
 import torch as T
@@ -5,27 +12,38 @@ import torch.multiprocessing as mp
 import torch.nn as nn
 import torch.nn.functional as F
 import matplotlib.pyplot as plt
-from torch.distributions import Categorical
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional. it is only needed for Agent(action_backend='numba')
+    njit = None
 
 # define global variable here
 # If you are running two separate processes, then they won't be sharing the same globals.
 # If you want to pass the data between the processes, look at using send and recv.
 # https://stackoverflow.com/questions/11215554/globals-variables-and-python-multiprocessing
+# so the episode rewards are written to a shared mp.Array (see __main__) instead of a global list
 N_GAMES = 4000
 T_MAX = 5
-rewards = []
+ENTROPY_BETA = 0.01  # weight of the entropy bonus, keeps the policy from collapsing early
+N_ENVS = 8  # number of environments stepped together by the synchronous A2C trainer
+SYNC_A2C = False  # True: single-process A2C over a vector env, False: asynchronous A3C workers
 
 
 # shared Adam optimizer
 # all worker shares the same Adam optimizer
+# foreach=True updates the whole parameter list with batched _foreach_* kernels instead of a python loop
 class SharedAdam(T.optim.Adam):
     def __init__(self, params, lr=1e-3, betas=(0.9, 0.99), eps=1e-8, weight_decay=0):
-        super(SharedAdam, self).__init__(params, lr=lr, betas=betas, eps=eps, weight_decay=weight_decay)
+        super(SharedAdam, self).__init__(params, lr=lr, betas=betas, eps=eps, weight_decay=weight_decay,
+                                         foreach=True)
 
         for group in self.param_groups:
             for p in group['params']:
                 state = self.state[p]
-                state['step'] = 0
+                # the foreach implementation expects step to be a tensor
+                state['step'] = T.zeros(())
+                state['step'].share_memory_()
                 state['exp_avg'] = T.zeros_like(p.data)
                 state['exp_avg_sq'] = T.zeros_like(p.data)
 
@@ -35,117 +53,259 @@ class SharedAdam(T.optim.Adam):
 
 # actor and critic class
 class ActorCritic(nn.Module):
-    def __init__(self, input_dims, n_actions, gamma=0.99):
+    # with_memory=False builds a forward-only network without the rollout buffers (e.g. an inference copy)
+    def __init__(self, input_dims, n_actions, gamma=0.99, with_memory=True):
         super(ActorCritic, self).__init__()
 
         self.gamma = gamma
 
+        # first layer of the policy and value network fused into one linear layer.
+        # the first 128 outputs feed the policy head and the last 128 outputs feed the value head.
+        # fan_in is unchanged, so the default init is the same as two separate Linear(input_dims, 128) layers
+        self.trunk = nn.Linear(*input_dims, 2 * 128)
+
         # policy network
-        self.policy_l1 = nn.Linear(*input_dims, 128)
         self.policy_l2 = nn.Linear(128, n_actions)
 
         # value network
-        self.value_l1 = nn.Linear(*input_dims, 128)
         self.value_l2 = nn.Linear(128, 1)
 
+        if not with_memory:
+            return
+
         # use these as accumulators
-        self.rewards = []
-        self.actions = []
-        self.states = []
-        self.next_states = []
+        # preallocated once per worker. self._n is the number of filled rows
+        self._states_buf = np.empty((T_MAX, *input_dims), dtype=np.float32)
+        self._next_states_buf = np.empty((T_MAX, *input_dims), dtype=np.float32)
+        self._actions_buf = np.empty(T_MAX, dtype=np.int64)  # actions are indices, so int64 for log_prob
+        self._rewards_buf = np.empty(T_MAX, dtype=np.float32)
+        self._returns_buf = np.empty(T_MAX, dtype=np.float32)
+        self._n = 0
+
+        # no tensor views over these buffers are cached here. under the spawn start method the worker is
+        # pickled, numpy arrays and tensors are copied separately and would no longer alias each other.
+        # T.from_numpy(buf[:n]) per update is zero-copy anyway
+
+        # gamma^0 ... gamma^T_MAX, reused by calc_R
+        self._gammas = (self.gamma ** np.arange(T_MAX + 1)).astype(np.float32)
 
     # accumulate state, action, reward for a period of time
     def remember(self, state, action, reward, next_state):
-        self.states.append(state)
-        self.actions.append(action)
-        self.rewards.append(reward)
-        self.next_states.append(next_state)
+        self._states_buf[self._n] = state
+        self._actions_buf[self._n] = action
+        self._rewards_buf[self._n] = reward
+        self._next_states_buf[self._n] = next_state
+        self._n += 1
 
     # once the episode terminates OR agent moves T_MAX steps clear the batch(=memory)
     def clear_memory(self):
-        self.states = []
-        self.actions = []
-        self.rewards = []
-        self.next_states = []
+        self._n = 0
 
     # forward state to the policy and value network
     def forward(self, state):
-        p1 = F.relu(self.policy_l1(state))
-        p2 = self.policy_l2(p1)  # final policy output. There are two outputs for the policy network
+        h = F.relu(self.trunk(state))
+
+        p2 = self.policy_l2(h[:, :128])  # final policy output. There are two outputs for the policy network
 
-        v1 = F.relu(self.value_l1(state))
-        v2 = self.value_l2(v1)  # final value output. There is one output for the value network
+        v2 = self.value_l2(h[:, 128:])  # final value output. There is one output for the value network
 
         return p2, v2  # We will after softmax p2 so that the action could be represented as a probability (L or R)
 
     # calculate return (= TD target)
-    def calc_R(self, done):
-        states = T.tensor(self.states, dtype=T.float)
-        next_states = T.tensor(self.next_states, dtype=T.float)
-
-        # forward all collected states
-        _, v = self.forward(states)
-        _, v_next = self.forward(next_states)
+    # v_last_next is the value of the last collected next_state, used for bootstrapping
+    def calc_R(self, done, v_last_next):
+        R = v_last_next * (1 - int(done))
+
+        # returns[t] = sum_k gamma^k * r[t+k] + gamma^(T-t) * R
+        #            = (sum_{j>=t} gamma^j * r[j] + gamma^T * R) / gamma^t
+        # computed in place in the preallocated returns buffer with a reversed cumulative sum
+        n = self._n
+        batch_return = self._returns_buf[:n]
+        np.multiply(self._rewards_buf[:n], self._gammas[:n], out=batch_return)
+        np.cumsum(batch_return[::-1], out=batch_return[::-1])
+        batch_return += self._gammas[n] * R
+        batch_return /= self._gammas[:n]
+
+        return T.from_numpy(batch_return)
 
-        # print("states shape", states.size())
-        # print("v shape", v.size())
-        # print("rewards shape", len(self.rewards))
-
-        R = v_next[-1] * (1 - int(done))
-
-        batch_return = []
+    def calc_loss(self, done):
+        states = T.from_numpy(self._states_buf[:self._n])
+        actions = T.from_numpy(self._actions_buf[:self._n])
 
-        for reward in self.rewards[::-1]:
-            R = reward + self.gamma * R
-            batch_return.append(R)
-        batch_return.reverse()
-        batch_return = T.tensor(batch_return, dtype=T.float)
+        # forward all collected states once. values are reused for the critic and actor losses
+        pi, values = self.forward(states)
 
-        return batch_return
+        # only the value of the last next_state is needed for the bootstrap
+        with T.inference_mode():
+            _, v_boot = self.forward(T.from_numpy(self._next_states_buf[self._n - 1:self._n]))
 
-    def calc_loss(self, done):
-        states = T.tensor(self.states, dtype=T.float)
-        actions = T.tensor(self.actions, dtype=T.float)
+        returns = self.calc_R(done, v_boot.item())  # returns (= TD-targets)
 
-        returns = self.calc_R(done)  # returns (= TD-targets)
+        return self.loss_from(pi, values, actions, returns)
 
-        pi, values = self.forward(states)
-        values = values.squeeze()
+    # actor-critic loss for a batch of policy outputs pi [N, n_actions], values [N, 1],
+    # actions [N] (int64) and returns [N]. shared by calc_loss and train_a2c
+    @staticmethod
+    def loss_from(pi, values, actions, returns):
+        values = values.squeeze(1)
         critic_loss = (returns - values) ** 2
 
-        probs = T.softmax(pi, dim=1)
-        dist = Categorical(probs)
-        log_probs = dist.log_prob(actions)
+        # log pi(a|s) in one log_softmax + gather, no Categorical object
+        all_log_probs = F.log_softmax(pi, dim=1)
+        log_probs = all_log_probs.gather(1, actions.view(-1, 1)).squeeze(1)
         actor_loss = -log_probs * (returns - values)
 
-        total_loss = (critic_loss + actor_loss).mean()
+        # entropy bonus from the same log_softmax output
+        entropy = -(all_log_probs.exp() * all_log_probs).sum(dim=1).mean()
+
+        total_loss = (critic_loss + actor_loss).mean() - ENTROPY_BETA * entropy
 
         return total_loss
 
+    # the output is only sampled from, so no autograd graph is recorded here
+    @T.inference_mode()
     def choose_action(self, state):
-        state = T.tensor([state], dtype=T.float)
+        # zero-copy view over the observation gym returned (only copied if it is not float32 already)
+        state = T.from_numpy(np.asarray(state, dtype=np.float32)).unsqueeze_(0)
+        state = state.to(self.trunk.weight.dtype)  # no-op unless the network was cast (e.g. to bfloat16)
         pi, v = self.forward(state)
-        probs = T.softmax(pi, dim=1)
-        dist = Categorical(probs)
-        action = dist.sample().numpy()[0]
+        action = self.sample_action(pi).item()
 
         return action
 
+    # choose actions for a batch of states (one state per environment) with a single forward
+    @T.inference_mode()
+    def choose_action_batch(self, states):
+        states = T.from_numpy(np.asarray(states, dtype=np.float32))
+        pi, v = self.forward(states)
+        actions = self.sample_action(pi).numpy()
+
+        return actions
+
+    # Gumbel-max trick: argmax(logits + gumbel noise) is a sample from softmax(logits).
+    # cheaper than building a Categorical object on every environment step
+    @staticmethod
+    def sample_action(logits):
+        logits = logits.float()
+        u = T.empty_like(logits).uniform_()
+        gumbel = -T.log(-T.log(u + 1e-20) + 1e-20)
+
+        return (logits + gumbel).argmax(dim=-1)
+
+
+# policy half of ActorCritic.forward plus Gumbel-max sampling, compiled by numba.
+# trunk_w / trunk_b are the first 128 rows of the trunk (the policy half), policy_w / policy_b the policy head
+def numba_choose_action(trunk_w, trunk_b, policy_w, policy_b, state):
+    n_hidden, n_inputs = trunk_w.shape
+    n_actions = policy_w.shape[0]
+
+    h = np.empty(n_hidden, dtype=np.float32)
+    for i in range(n_hidden):
+        acc = trunk_b[i]
+        for j in range(n_inputs):
+            acc += trunk_w[i, j] * state[j]
+        h[i] = acc if acc > 0 else 0
+
+    best_action = 0
+    best_value = -np.inf
+    for a in range(n_actions):
+        logit = policy_b[a]
+        for i in range(n_hidden):
+            logit += policy_w[a, i] * h[i]
+        gumbel = -np.log(-np.log(np.random.random() + 1e-20) + 1e-20)
+        if logit + gumbel > best_value:
+            best_value = logit + gumbel
+            best_action = a
+
+    return best_action
+
+
+if njit is not None:
+    numba_choose_action = njit(cache=True)(numba_choose_action)
+
 
 class Agent(mp.Process):
     def __init__(self, global_actor_critic, optimizer, input_dims, n_actions,
-                 gamma, lr, name, global_ep_idx, env_id):
+                 gamma, lr, name, global_ep_idx, env_id, rewards_arr,
+                 use_torch_compile=True, accum_every=4, action_backend='bf16'):
         super(Agent, self).__init__()
         self.local_actor_critic = ActorCritic(input_dims, n_actions, gamma)
         self.global_actor_critic = global_actor_critic
+        self._local_params = list(self.local_actor_critic.parameters())
+        self._global_params = list(self.global_actor_critic.parameters())
         self.name = 'w%02i' % name
         self.episode_idx = global_ep_idx
+        self.rewards_arr = rewards_arr  # shared reward of every episode, indexed by the global episode number
         self.env = gym.make(env_id)
         self.optimizer = optimizer  # global network
         self.max_episode = 0
+        self.use_torch_compile = use_torch_compile
+        # gradients of accum_every T_MAX windows are summed locally before one global step
+        self.accum_every = accum_every
+        self._accum_ctr = 0
+
+        # how actions are chosen during the rollout (default 'bf16', which needs no optional package)
+        # 'torch': the local network's choose_action
+        # 'bf16':  choose_action of a bfloat16 copy of the local network
+        # 'numba': numba_choose_action on the local network's fp32 weights
+        if action_backend not in ('torch', 'bf16', 'numba'):
+            raise ValueError(f"unknown action_backend {action_backend!r}, expected 'torch', 'bf16' or 'numba'")
+        if action_backend == 'numba' and njit is None:
+            raise ImportError("action_backend='numba' requires numba to be installed")
+        self.action_backend = action_backend
+
+        # forward-only copy of the local network used to choose actions. in bfloat16 it reads half the bytes
+        # per weight. it is refreshed from the local network after every global step
+        self.infer_actor_critic = self.local_actor_critic
+        if action_backend == 'bf16':
+            self.infer_actor_critic = ActorCritic(input_dims, n_actions, gamma, with_memory=False).bfloat16()
+            self._infer_params = list(self.infer_actor_critic.parameters())
+            self.sync_infer_net()
+
+    # copy the (fp32) local network into the inference network, casting to its dtype
+    def sync_infer_net(self):
+        if self.infer_actor_critic is self.local_actor_critic:
+            return
+
+        with T.no_grad():
+            for infer_param, local_param in zip(self._infer_params, self._local_params):
+                infer_param.copy_(local_param)
 
     def run(self):
-        global rewards
+        T.set_num_threads(1)
+        T.set_num_interop_threads(1)
+
+        # compile inside the worker process. inputs only come in a few fixed shapes ([1, 4] up to [T_MAX, 4])
+        # so each shape is compiled once and cached
+        if self.use_torch_compile:
+            self.local_actor_critic.forward = T.compile(self.local_actor_critic.forward,
+                                                        dynamic=False,
+                                                        mode="reduce-overhead")
+            if self.infer_actor_critic is not self.local_actor_critic:
+                self.infer_actor_critic.forward = T.compile(self.infer_actor_critic.forward,
+                                                            dynamic=False,
+                                                            mode="reduce-overhead")
+
+        # one flat gradient buffer per worker. the local and the global parameters both get views into it
+        # as their .grad, so backward() writes straight into the gradients the optimizer steps on
+        # and no per-parameter hand-over is needed after every update
+        self._flat_grad = T.zeros(sum(p.numel() for p in self._local_params))
+        offset = 0
+        for local_param, global_param in zip(self._local_params, self._global_params):
+            grad_view = self._flat_grad[offset:offset + local_param.numel()].view_as(local_param)
+            local_param.grad = grad_view
+            global_param.grad = grad_view
+            offset += local_param.numel()
+
+        # numpy views over the local policy weights for numba_choose_action. local parameters are only
+        # updated in place (copy_ from the global network), so these views always see the current weights
+        if self.action_backend == 'numba':
+            trunk, policy = self.local_actor_critic.trunk, self.local_actor_critic.policy_l2
+            numba_weights = (trunk.weight.detach().numpy()[:128],
+                             trunk.bias.detach().numpy()[:128],
+                             policy.weight.detach().numpy(),
+                             policy.bias.detach().numpy())
+
         t_step = 1
 
         while self.episode_idx.value < N_GAMES:
@@ -155,7 +315,10 @@ class Agent(mp.Process):
             self.local_actor_critic.clear_memory()
 
             while not done:
-                action = self.local_actor_critic.choose_action(state)
+                if self.action_backend == 'numba':
+                    action = numba_choose_action(*numba_weights, np.asarray(state, dtype=np.float32))
+                else:
+                    action = self.infer_actor_critic.choose_action(state)
                 next_state, reward, done, info = self.env.step(action)
                 score += reward
 
@@ -164,19 +327,21 @@ class Agent(mp.Process):
 
                 if t_step % T_MAX == 0 or done:
                     loss = self.local_actor_critic.calc_loss(done)
-                    self.optimizer.zero_grad()
-                    loss.backward()
+                    loss.backward()  # accumulates into the flat gradient buffer
+                    self._accum_ctr += 1
 
-                    # local network passes parameter to the global network
-                    for local_param, global_param in zip(self.local_actor_critic.parameters(),
-                                                         self.global_actor_critic.parameters()):
-                        global_param._grad = local_param.grad
+                    if self._accum_ctr % self.accum_every == 0:
+                        # global network's step. its gradients are the local gradients (same flat buffer)
+                        self.optimizer.step()
 
-                    # global network's step
-                    self.optimizer.step()
+                        # copy the global network to the local network parameter by parameter (no state_dict is built)
+                        with T.no_grad():
+                            for local_param, global_param in zip(self._local_params, self._global_params):
+                                local_param.copy_(global_param)
+                        self.sync_infer_net()
 
-                    # copy the global network to the local network
-                    self.local_actor_critic.load_state_dict(self.global_actor_critic.state_dict())
+                        # zero in place so the .grad views stay attached to the flat buffer
+                        self._flat_grad.zero_()
 
                     # clear the batch(=memory)
                     self.local_actor_critic.clear_memory()
@@ -186,17 +351,77 @@ class Agent(mp.Process):
 
             with self.episode_idx.get_lock():
                 self.episode_idx.value += 1
-
-            print('worker: ', self.name, 'episode: ', self.episode_idx.value, 'reward: ', score)
-            rewards.append(score)
-
-        # plot rewards for every worker here
-        fig, ax = plt.subplots(figsize=(10, 6))
-        ax.plot(np.linspace(0, len(rewards), len(rewards)), rewards)
-        ax.set_title(f'Worker {self.name}')
-        ax.set_xlabel('Episode')
-        ax.set_ylabel('Reward')
-        plt.show()
+                episode = self.episode_idx.value
+
+            print('worker: ', self.name, 'episode: ', episode, 'reward: ', score)
+            # workers that were mid-episode when N_GAMES was reached finish past the end of the array
+            if episode <= N_GAMES:
+                self.rewards_arr[episode - 1] = score
+
+        # apply the gradients of the windows accumulated since the last global step
+        if self._accum_ctr % self.accum_every != 0:
+            self.optimizer.step()
+            self._flat_grad.zero_()
+
+
+# synchronous A2C: one process steps N_ENVS environments and runs a single forward for all of them
+def train_a2c(env_id, input_dims, n_actions, n_envs, gamma, lr):
+    envs = gym.vector.SyncVectorEnv([lambda: gym.make(env_id)] * n_envs)
+    actor_critic = ActorCritic(input_dims, n_actions, gamma)
+    # there is no asynchrony here, so the plain Adam optimizer is enough
+    optimizer = T.optim.Adam(actor_critic.parameters(), lr=lr, betas=(0.92, 0.999))
+
+    # rollout buffers of shape [T_MAX, n_envs, ...]
+    states_buf = np.empty((T_MAX, n_envs, *input_dims), dtype=np.float32)
+    actions_buf = np.empty((T_MAX, n_envs), dtype=np.int64)
+    rewards_buf = np.empty((T_MAX, n_envs), dtype=np.float32)
+    dones_buf = np.empty((T_MAX, n_envs), dtype=np.float32)
+
+    episode_rewards = []
+    scores = np.zeros(n_envs)
+    states = envs.reset()
+
+    while len(episode_rewards) < N_GAMES:
+        for t in range(T_MAX):
+            actions = actor_critic.choose_action_batch(states)
+            # finished environments are reset automatically by the vector env
+            next_states, env_rewards, dones, infos = envs.step(actions)
+
+            states_buf[t] = states
+            actions_buf[t] = actions
+            rewards_buf[t] = env_rewards
+            dones_buf[t] = dones
+
+            scores += env_rewards
+            for score in scores[dones]:
+                episode_rewards.append(score)
+                print('episode: ', len(episode_rewards), 'reward: ', score)
+            scores[dones] = 0
+
+            states = next_states
+
+        # bootstrap from the states after the last step
+        with T.inference_mode():
+            _, v_boot = actor_critic.forward(T.from_numpy(np.asarray(states, dtype=np.float32)))
+
+        # returns (= TD-targets). an episode that ended at step t does not bootstrap past t
+        R = v_boot.squeeze(1).numpy()
+        returns = np.empty((T_MAX, n_envs), dtype=np.float32)
+        for t in reversed(range(T_MAX)):
+            R = rewards_buf[t] + gamma * R * (1 - dones_buf[t])
+            returns[t] = R
+        returns = T.from_numpy(returns.reshape(-1))
+
+        # one fused forward over the whole [T_MAX * n_envs] rollout
+        pi, values = actor_critic.forward(T.from_numpy(states_buf.reshape(-1, *input_dims)))
+        loss = ActorCritic.loss_from(pi, values, T.from_numpy(actions_buf.reshape(-1)), returns)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+    envs.close()
+
+    return episode_rewards
 
 
 if __name__ == '__main__':
@@ -206,27 +431,48 @@ if __name__ == '__main__':
     n_actions = 2
     input_dims = [4]
 
-    global_actor_critic = ActorCritic(input_dims, n_actions)
-    global_actor_critic.share_memory()
-    optim = SharedAdam(global_actor_critic.parameters(),
-                       lr=lr,
-                       betas=(0.92, 0.999))
-    global_ep = mp.Value('i', 0)
-
-    workers = [Agent(global_actor_critic,
-                     optim,
-                     input_dims,
-                     n_actions,
-                     gamma=0.99,
-                     lr=lr,
-                     name=i,
-                     global_ep_idx=global_ep,
-                     env_id=env_id
-                     ) for i in range(mp.cpu_count())
-               ]
-
-    [w.start() for w in workers]
-    [w.join() for w in workers]
-
-    # see the following for the join() method:
-    # https://stackoverflow.com/questions/25391025/what-exactly-is-python-multiprocessing-modules-join-method-doing
+    if SYNC_A2C:
+        rewards = train_a2c(env_id, input_dims, n_actions, N_ENVS, gamma=0.99, lr=lr)
+
+        fig, ax = plt.subplots(figsize=(10, 6))
+        ax.plot(np.linspace(0, len(rewards), len(rewards)), rewards)
+        ax.set_title('A2C')
+        ax.set_xlabel('Episode')
+        ax.set_ylabel('Reward')
+        plt.show()
+    else:
+        global_actor_critic = ActorCritic(input_dims, n_actions)
+        global_actor_critic.share_memory()
+        optim = SharedAdam(global_actor_critic.parameters(),
+                           lr=lr,
+                           betas=(0.92, 0.999))
+        global_ep = mp.Value('i', 0)
+        rewards_arr = mp.Array('f', N_GAMES, lock=False)
+
+        workers = [Agent(global_actor_critic,
+                         optim,
+                         input_dims,
+                         n_actions,
+                         gamma=0.99,
+                         lr=lr,
+                         name=i,
+                         global_ep_idx=global_ep,
+                         env_id=env_id,
+                         rewards_arr=rewards_arr
+                         ) for i in range(mp.cpu_count())
+                   ]
+
+        [w.start() for w in workers]
+        [w.join() for w in workers]
+
+        # see the following for the join() method:
+        # https://stackoverflow.com/questions/25391025/what-exactly-is-python-multiprocessing-modules-join-method-doing
+
+        # plot the rewards of all workers once, after training (rewards_arr is lock=False, so a plain ctypes array)
+        rewards = np.frombuffer(rewards_arr, dtype=np.float32)[:min(global_ep.value, N_GAMES)]
+        fig, ax = plt.subplots(figsize=(10, 6))
+        ax.plot(np.linspace(0, len(rewards), len(rewards)), rewards)
+        ax.set_title('A3C')
+        ax.set_xlabel('Episode')
+        ax.set_ylabel('Reward')
+        plt.show()